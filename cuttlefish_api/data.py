@@ -1,14 +1,14 @@
 from dataclasses import dataclass
-from enum import Enum
+from enum import IntEnum
 
 
-class BatteryAction(Enum):
+class BatteryAction(IntEnum):
     DISCHARGE = -1
     OFF = 0
     CHARGE = 1
 
 
-class ApplianceAction(Enum):
+class ApplianceAction(IntEnum):
     OFF = 0
     ON = 1
 
@@ -1,19 +1,29 @@
 import argparse
+import hashlib
+import hmac
+import logging
 import math
+import signal
 import tomllib
-from dataclasses import asdict, dataclass, is_dataclass
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from enum import Enum
-from itertools import groupby
-from json import JSONEncoder, dumps, loads, load
 from sqlite3 import connect
+from threading import local
 from uuid import uuid4
 
 import dacite
+import msgspec
+import numpy as np
+import orjson
 from bjoern import run
-from dacite import Config, from_dict
-from falcon import App, HTTP_200, MEDIA_JSON, HTTP_400, HTTP_204
+from falcon import App, HTTP_200, MEDIA_JSON, HTTP_400, HTTP_204, HTTP_304
 from falcon_auth import FalconAuthMiddleware, TokenAuthBackend
-from pendulum import now
+from msgspec import Struct, structs
+
+from cuttlefish_api.tasks import build_tasks, find_runs
+
+logger = logging.getLogger(__name__)
 
 CREATE_TABLE_PROBLEMS = """
     CREATE TABLE IF NOT EXISTS problems (
@@ -24,7 +34,8 @@ CREATE_TABLE_PROBLEMS = """
         queued_at TIMESTAMP,
         result_at TIMESTAMP,
         result_status INTEGER,
-        result_data JSON
+        result_data JSON,
+        problem_hash BLOB
     )
     """
 
@@ -58,6 +69,83 @@ CREATE_TABLE_SURVEY = """
         )
     """
 
+CREATE_INDEX_PROBLEMS_RESOURCE_UUID = "CREATE UNIQUE INDEX IF NOT EXISTS idx_problems_resource_uuid ON problems(resource_uuid)"
+
+CREATE_INDEX_PROBLEMS_PROBLEM_HASH = "CREATE UNIQUE INDEX IF NOT EXISTS idx_problems_problem_hash ON problems(problem_hash)"
+
+CREATE_TABLES = ";".join([CREATE_TABLE_PROBLEMS, CREATE_TABLE_REQUESTS, CREATE_TABLE_USERS, CREATE_TABLE_SURVEY])
+
+CREATE_INDEXES = ";".join([CREATE_INDEX_PROBLEMS_RESOURCE_UUID, CREATE_INDEX_PROBLEMS_PROBLEM_HASH])
+
+SELECT_PROBLEM = "SELECT problem_data, result_status, result_data FROM problems WHERE resource_uuid = ?"
+
+INSERT_PROBLEM = "INSERT INTO problems (created_at, problem_data, resource_uuid, queued_at, result_at, result_status, result_data, problem_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(problem_hash) DO UPDATE SET problem_hash = excluded.problem_hash RETURNING problem_id, resource_uuid"
+
+INSERT_REQUEST = "INSERT INTO requests (user_id, created_at, problem_id) VALUES (?, ?, ?)"
+
+SELECT_API_TOKEN = "SELECT api_token FROM users WHERE username = ? LIMIT 1"
+
+SELECT_USER = "SELECT user_id, api_token FROM users WHERE username = ? LIMIT 1"
+
+SELECT_USERS = "SELECT username, user_id, api_token FROM users"
+
+INSERT_USER = "INSERT OR IGNORE INTO users (created_at, username, api_token) VALUES (?, ?, ?)"
+
+INSERT_SURVEY_RESPONSE = "INSERT INTO SURVEY (user_id, created_at, response_data) VALUES (?, ?, ?)"
+
+
+def timestamp():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def problem_hash(problem_data):
+    return hashlib.blake2b(problem_data, digest_size=16).digest()
+
+
+def add_problem_hash_column(connection):
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(problems)")]
+    if "problem_hash" not in columns:
+        connection.execute("ALTER TABLE problems ADD COLUMN problem_hash BLOB")
+        hashes = {}
+        for problem_id, problem_data in connection.execute("SELECT problem_id, problem_data FROM problems ORDER BY problem_id").fetchall():
+            try:
+                home_parameters = msgspec.json.decode(problem_data, type=HomeParameters)
+            except Exception:
+                continue
+            hashes.setdefault(problem_hash(msgspec.json.encode(home_parameters, order="sorted")), problem_id)
+        connection.executemany("UPDATE problems SET problem_hash = ? WHERE problem_id = ?", hashes.items())
+
+
+def init_db(db_path):
+    connection = connect(db_path)
+    connection.execute("PRAGMA page_size=4096")
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(CREATE_TABLES)
+    add_problem_hash_column(connection)
+    connection.executescript(CREATE_INDEXES)
+    connection.commit()
+    connection.close()
+
+
+class ConnectionCache(local):
+    def __init__(self):
+        self.connections = {}
+
+
+connection_cache = ConnectionCache()
+
+
+def get_connection(db_path):
+    connection = connection_cache.connections.get(db_path)
+    if connection is None:
+        connection = connect(db_path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-65536")
+        connection.execute("PRAGMA mmap_size=268435456")
+        connection_cache.connections[db_path] = connection
+    return connection
+
 
 @dataclass
 class APIConfig:
@@ -84,16 +172,22 @@ class GlobalConfig:
 
 class PriceResource:
     def __init__(self, data):
-        self.data = data
+        self.body = orjson.dumps(data)
+        self.etag = hashlib.blake2b(self.body, digest_size=16).hexdigest()
 
     def on_get(self, request, response):
-        response.status = HTTP_200
-        response.content_type = MEDIA_JSON
-        response.text = dumps(self.data)
+        response.cache_control = ["private", "max-age=86400"]
+        response.etag = self.etag
 
+        if request.if_none_match is not None and any(etag in ("*", self.etag) for etag in request.if_none_match):
+            response.status = HTTP_304
+        else:
+            response.status = HTTP_200
+            response.content_type = MEDIA_JSON
+            response.data = self.body
 
-@dataclass(frozen=True)
-class BatteryParameters:
+
+class BatteryParameters(Struct, frozen=True):
     capacity: int
     rate: float
     initial_level: int
@@ -106,14 +200,13 @@ class BatteryParameters:
         assert 0 <= self.min_required_level <= self.capacity
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return structs.asdict(self).__repr__()
 
     def __str__(self):
-        return self.__dict__.__str__()
+        return structs.asdict(self).__str__()
 
 
-@dataclass(frozen=True)
-class WindowParameters:
+class WindowParameters(Struct, frozen=True):
     timesteps: set[int]
     min_required_cycles: int
 
@@ -121,8 +214,7 @@ class WindowParameters:
         assert self.min_required_cycles >= 0
 
 
-@dataclass(frozen=True)
-class ApplianceParameters:
+class ApplianceParameters(Struct, frozen=True):
     label: str
     duration: int
     rate: float
@@ -136,14 +228,13 @@ class ApplianceParameters:
         assert all(dependency is None or 0 < dependency < math.inf for dependency in self.dependencies)
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return structs.asdict(self).__repr__()
 
     def __str__(self):
-        return self.__dict__.__str__()
+        return structs.asdict(self).__str__()
 
 
-@dataclass(frozen=True)
-class HomeParameters:
+class HomeParameters(Struct, frozen=True):
     horizon: int
     battery: BatteryParameters
     appliances: tuple[ApplianceParameters, ...]
@@ -152,47 +243,10 @@ class HomeParameters:
         assert self.horizon > 0
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return structs.asdict(self).__repr__()
 
     def __str__(self):
-        return self.__dict__.__str__()
-
-
-class HomeParametersEncoder(JSONEncoder):
-    def default(self, obj):
-        if is_dataclass(obj):
-            return asdict(obj)
-        if isinstance(obj, set):
-            return sorted(obj)
-        return super().default(obj)
-
-
-def iter_appliance_tasks(appliance_label, appliance_plan, cycle_duration):
-    timestep = 0
-    for appliance_action, group in groupby(appliance_plan):
-        action_duration = sum(1 for _ in group)
-        if appliance_action != 0:
-            assert action_duration % cycle_duration == 0, f"{action_duration} % {cycle_duration} == 0 <=> {action_duration % cycle_duration} == 0"
-            for _ in range(action_duration // cycle_duration):
-                yield {"device": appliance_label, "action": "On", "start": timestep, "duration": cycle_duration}
-                timestep += cycle_duration
-        else:
-            timestep += action_duration
-
-
-def iter_battery_tasks(battery_plan):
-    timestep = 0
-    for battery_action, group in groupby(battery_plan):
-        duration = sum(1 for _ in group)
-        if battery_action != 0:
-            yield {"device": "Battery", "action": "Discharge" if battery_action == -1 else "Charge", "start": timestep, "duration": duration}
-        timestep += duration
-
-
-def iter_tasks(plan, appliance_labels, appliance_durations):
-    for appliance_index, (appliance_label, appliance_duration) in enumerate(zip(appliance_labels, appliance_durations)):
-        yield from iter_appliance_tasks(appliance_label, [action["appliances"][appliance_index] for action in plan], appliance_duration)
-    yield from iter_battery_tasks([action["battery"] for action in plan])
+        return structs.asdict(self).__str__()
 
 
 def calculate_cost(plan, prices, home_parameters):
@@ -213,41 +267,48 @@ class ResultStatus(Enum):
 
 
 class TasksResource:
-    def __init__(self, db_path, prices):
+    def __init__(self, db_path, prices, cache_size=4096):
         self.db_path = db_path
         self.prices = prices
+        self.cache_size = cache_size
+        self.solutions = {}
 
     def on_get(self, request, response, problem_id):
-        connection = connect(self.db_path)
-        cursor = connection.cursor()
-
-        cursor.execute("PRAGMA journal_mode=WAL")
+        solution = self.solutions.pop(problem_id, None)
+        if solution is not None:
+            self.solutions[problem_id] = solution  # re-insert so eviction drops the least recently used entry
+            response.status = HTTP_200
+            response.content_type = MEDIA_JSON
+            response.data = solution
+            return
 
-        cursor.execute(CREATE_TABLE_PROBLEMS)
+        cursor = get_connection(self.db_path).cursor()
 
         try:
-            result = cursor.execute("SELECT problem_data, result_status, result_data FROM problems WHERE resource_uuid = ?", (problem_id, )).fetchone()
+            result = cursor.execute(SELECT_PROBLEM, (problem_id, )).fetchone()
             problem_data, result_status, result_data = result
 
-            connection.close()
-
             if result_status is not None:
                 status = ResultStatus(result_status)
 
                 if status == ResultStatus.Solved:
-                    home_parameters = from_dict(data_class=HomeParameters, data=loads(problem_data), config=Config(cast=[tuple, set]))
+                    home_parameters = msgspec.json.decode(problem_data, type=HomeParameters)
                     appliance_labels = [appliance.label for appliance in home_parameters.appliances]
                     appliance_durations = [appliance.duration for appliance in home_parameters.appliances]
-                    plan = loads(result_data) if result_data is not None else []
-                    tasks = list(iter_tasks(plan, appliance_labels, appliance_durations))
+                    plan = orjson.loads(result_data) if result_data is not None else []
+                    tasks = build_tasks(plan, appliance_labels, appliance_durations)
                     cost = calculate_cost(plan, self.prices, home_parameters)
+                    solution = orjson.dumps({"status": status.name, "tasks": tasks, "cost": cost})
+                    if len(self.solutions) >= self.cache_size:
+                        del self.solutions[next(iter(self.solutions))]
+                    self.solutions[problem_id] = solution
                     response.status = HTTP_200
                     response.content_type = MEDIA_JSON
-                    response.text = dumps({"status": status.name, "tasks": tasks, "cost": cost}, separators=(",", ":"))
+                    response.data = solution
                 else:
                     response.status = HTTP_200
                     response.content_type = MEDIA_JSON
-                    response.text = dumps({"status": status.name}, separators=(",", ":"))
+                    response.data = orjson.dumps({"status": status.name})
 
             else:
                 response.status = HTTP_204
@@ -261,39 +322,30 @@ class RequirementsResource:
 
     def on_post(self, request, response):
         try:
-            home_parameters = from_dict(data_class=HomeParameters, data=request.media, config=Config(cast=[tuple, set]))
+            home_parameters = msgspec.json.decode(request.bounded_stream.read(), type=HomeParameters)
 
             if any(dependency is not None for appliance in home_parameters.appliances for dependency in appliance.dependencies):
                 raise Exception("appliance dependencies are not currently supported")
 
-            connection = connect(self.db_path)
+            connection = get_connection(self.db_path)
             cursor = connection.cursor()
 
-            cursor.execute("PRAGMA journal_mode=WAL")
-
-            cursor.execute(CREATE_TABLE_PROBLEMS)
+            problem_data = msgspec.json.encode(home_parameters, order="sorted")
+            request_hash = problem_hash(problem_data)
 
-            result = cursor.execute("SELECT problem_id, resource_uuid FROM problems WHERE problem_data = ?", (dumps(request.media, separators=(",", ":")), )).fetchone()
+            with connection:
+                cursor.execute("BEGIN IMMEDIATE")
 
-            if result is None:
-                resource_uuid = str(uuid4())
-                data = now().to_iso8601_string(), dumps(home_parameters, cls=HomeParametersEncoder, separators=(",", ":")), resource_uuid, None, None, None, None
-                result = cursor.execute("INSERT OR IGNORE INTO problems (created_at, problem_data, resource_uuid, queued_at, result_at, result_status, result_data) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING problem_id, resource_uuid", data).fetchone()
+                data = timestamp(), problem_data.decode(), str(uuid4()), None, None, None, None, request_hash
+                problem_id, resource_uuid = cursor.execute(INSERT_PROBLEM, data).fetchone()
 
-            problem_id, resource_uuid = result
-
-            cursor.execute(CREATE_TABLE_REQUESTS)
-
-            data = request.context["user"]["user_id"], now().to_iso8601_string(), problem_id
-            print(f"INSERT {data}")
-            cursor.execute("INSERT INTO requests (user_id, created_at, problem_id) VALUES (?, ?, ?)", data)
-
-            connection.commit()
-            connection.close()
+                data = request.context["user"]["user_id"], timestamp(), problem_id
+                logger.debug("INSERT %s", data)
+                cursor.execute(INSERT_REQUEST, data)
 
             response.status = HTTP_200
             response.content_type = MEDIA_JSON
-            response.text = dumps({"resource": resource_uuid}, separators=(",", ":"))
+            response.data = orjson.dumps({"resource": resource_uuid})
         except Exception:
             response.status = HTTP_400
 
@@ -310,53 +362,57 @@ class LoginResource:
         username = request.media["username"] if "username" in request.media else None
 
         if username is not None and username.isalnum():
-            connection = connect(self.db_path)
-            cursor = connection.cursor()
-
-            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor = get_connection(self.db_path).cursor()
 
-            cursor.execute(CREATE_TABLE_USERS)
-
-            result = cursor.execute("SELECT api_token FROM users WHERE username = ? LIMIT 1", (username, )).fetchone()
+            result = cursor.execute(SELECT_API_TOKEN, (username, )).fetchone()
             api_token = result[0] if result is not None and len(result) > 0 else None
 
             if api_token is None:
                 api_token = str(uuid4())
-                row = now().to_iso8601_string(), username, api_token
-                cursor.execute("INSERT OR IGNORE INTO users (created_at, username, api_token) VALUES (?, ?, ?)", row)
-
-            connection.commit()
-            connection.close()
+                row = timestamp(), username, api_token
+                cursor.execute(INSERT_USER, row)
 
             response.status = HTTP_200
             response.content_type = MEDIA_JSON
-            response.text = dumps({"username": username, "token": api_token}, separators=(",", ":"))
+            response.data = orjson.dumps({"username": username, "token": api_token})
         else:
             response.status = HTTP_400
 
 
-def user_validator(db_path, username, api_token):
-    connection = connect(db_path)
-    cursor = connection.cursor()
+def load_users(db_path):
+    cursor = get_connection(db_path).cursor()
 
-    cursor.execute("PRAGMA journal_mode=WAL")
+    return {username: (user_id, api_token) for username, user_id, api_token in cursor.execute(SELECT_USERS)}
 
-    cursor.execute(CREATE_TABLE_USERS)
 
-    result = cursor.execute("SELECT user_id, username, api_token FROM users WHERE username = ? AND api_token = ? LIMIT 1", (username, api_token)).fetchone()
+def reload_users(db_path, users):
+    loaded_users = load_users(db_path)
+    for username in users.keys() - loaded_users.keys():
+        del users[username]
+    users.update(loaded_users)
 
-    connection.close()
 
-    return {"user_id": result[0], "username": result[1]} if result is not None and result[1] == username and result[2] == api_token else None
+def user_validator(db_path, users, username, api_token):
+    user = users.get(username)
 
+    if user is None or not hmac.compare_digest(user[1].encode(), api_token.encode()):
+        cursor = get_connection(db_path).cursor()
 
-def add_test_users(db_path):
-    connection = connect(db_path)
-    cursor = connection.cursor()
+        user = cursor.execute(SELECT_USER, (username, )).fetchone()
+        if user is None:
+            users.pop(username, None)
+            return None
+        users[username] = user
+
+        if not hmac.compare_digest(user[1].encode(), api_token.encode()):
+            return None
 
-    cursor.execute("PRAGMA journal_mode=WAL")
+    return {"user_id": user[0], "username": username}
 
-    cursor.execute(CREATE_TABLE_USERS)
+
+def add_test_users(db_path):
+    connection = get_connection(db_path)
+    cursor = connection.cursor()
 
     api_tokens = {
         "alice": "028b6996-18be-419b-a6a2-5b14acca0418",
@@ -366,12 +422,11 @@ def add_test_users(db_path):
 
     def iter_insert_rows():
         for username, api_token in api_tokens.items():
-            yield now().to_iso8601_string(), username, api_token
+            yield timestamp(), username, api_token
 
-    cursor.executemany("INSERT OR IGNORE INTO users (created_at, username, api_token) VALUES (?, ?, ?)", iter_insert_rows())
-
-    connection.commit()
-    connection.close()
+    with connection:
+        cursor.execute("BEGIN")
+        cursor.executemany(INSERT_USER, iter_insert_rows())
 
 
 class SurveyResource:
@@ -379,21 +434,19 @@ class SurveyResource:
         self.db_path = db_path
 
     def on_post(self, request, response):
-        connection = connect(self.db_path)
-        cursor = connection.cursor()
-
-        cursor.execute("PRAGMA journal_mode=WAL")
-
-        cursor.execute(CREATE_TABLE_SURVEY)
+        try:
+            response_data = request.bounded_stream.read()
+            msgspec.json.decode(response_data)
 
-        data = request.context["user"]["user_id"], now().to_iso8601_string(), dumps(request.media, separators=(",", ":"))
-        print(f"INSERT {data}")
-        cursor.execute("INSERT INTO SURVEY (user_id, created_at, response_data) VALUES (?, ?, ?)", data)
+            cursor = get_connection(self.db_path).cursor()
 
-        connection.commit()
-        connection.close()
+            data = request.context["user"]["user_id"], timestamp(), response_data.decode()
+            logger.debug("INSERT %s", data)
+            cursor.execute(INSERT_SURVEY_RESPONSE, data)
 
-        response.status = HTTP_200
+            response.status = HTTP_200
+        except Exception:
+            response.status = HTTP_400
 
 
 def cli():
@@ -405,20 +458,23 @@ def cli():
 
     config = dacite.from_dict(GlobalConfig, toml_data)
 
-    with open(config.prices.path) as json_file:
-        dataset = load(json_file)
+    with open(config.prices.path, "rb") as json_file:
+        dataset = orjson.loads(json_file.read())
         selected_keys = {"import_price", "export_price"}
         prices = [{key: datapoint[key] for key in datapoint if key in selected_keys} for datapoint in dataset]
         assert len(prices) == 168
         assert all("import_price" in datapoint and "export_price" in datapoint and datapoint["import_price"] is not None and datapoint["export_price"] is not None for datapoint in prices)
 
+    init_db(config.database.path)
     add_test_users(config.database.path)
+    users = load_users(config.database.path)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_users(config.database.path, users))
+    find_runs(np.zeros((1, 1), dtype=np.int8))  # compile the kernel before serving requests
 
     def user_loader(bearer_token):
-        tokens = [token.strip() for token in bearer_token.split(",")]
-        if len(tokens) == 2:
-            username, api_token = tokens
-            return user_validator(config.database.path, username, api_token)
+        username, separator, api_token = bearer_token.partition(",")
+        if separator:
+            return user_validator(config.database.path, users, username.strip(), api_token.strip())
         return None
 
     auth_backend = TokenAuthBackend(user_loader, auth_header_prefix="Bearer")
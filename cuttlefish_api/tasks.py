@@ -0,0 +1,59 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def find_runs_numpy(actions):
+    changes = np.diff(actions, axis=0, prepend=actions[:1] ^ 1) != 0
+    devices, starts = np.nonzero(changes.T)
+    durations = np.diff(devices * len(actions) + starts, append=actions.size)
+    return devices, starts, durations, actions[starts, devices]
+
+
+def scan_runs(actions):
+    timesteps, columns = actions.shape
+    devices = np.empty(actions.size, dtype=np.int32)
+    starts = np.empty(actions.size, dtype=np.int32)
+    durations = np.empty(actions.size, dtype=np.int32)
+    values = np.empty(actions.size, dtype=np.int8)
+    runs = 0
+    for column in range(columns):
+        for timestep in range(timesteps):
+            if timestep == 0 or actions[timestep, column] != actions[timestep - 1, column]:
+                devices[runs] = column
+                starts[runs] = timestep
+                durations[runs] = 1
+                values[runs] = actions[timestep, column]
+                runs += 1
+            else:
+                durations[runs - 1] += 1
+    return devices[:runs], starts[:runs], durations[:runs], values[:runs]
+
+
+find_runs = njit(cache=True)(scan_runs) if njit is not None else find_runs_numpy
+
+
+def build_tasks(plan, appliance_labels, appliance_durations):
+    tasks = []
+    if len(plan) == 0:
+        return tasks
+    battery_index = len(plan[0]["appliances"])
+    values = []
+    for action in plan:
+        values += action["appliances"]
+        values.append(action["battery"])
+    actions = np.array(values, dtype=np.int8).reshape(len(plan), battery_index + 1)
+    for device_index, timestep, duration, action in zip(*(runs.tolist() for runs in find_runs(actions))):
+        if action == 0:
+            continue
+        if device_index == battery_index:
+            tasks.append({"device": "Battery", "action": "Discharge" if action == -1 else "Charge", "start": timestep, "duration": duration})
+        elif device_index < len(appliance_labels):
+            appliance_label, cycle_duration = appliance_labels[device_index], appliance_durations[device_index]
+            assert duration % cycle_duration == 0, f"{duration} % {cycle_duration} == 0 <=> {duration % cycle_duration} == 0"
+            for cycle_start in range(timestep, timestep + duration, cycle_duration):
+                tasks.append({"device": appliance_label, "action": "On", "start": cycle_start, "duration": cycle_duration})
+    return tasks
@@ -13,9 +13,14 @@ setup(
         "dacite",
         "falcon",
         "falcon_auth",
-        "pendulum",
+        "msgspec",
+        "numpy",
+        "orjson",
     ],
-    extras_require={},
+    extras_require={
+        "jit": ["numba"],
+        "test": ["pytest"],
+    },
     classifiers=[],
     include_package_data=True,
     platforms="any",
@@ -0,0 +1,60 @@
+import random
+from itertools import groupby
+
+import numpy as np
+
+from cuttlefish_api.tasks import build_tasks, find_runs, find_runs_numpy, scan_runs
+
+
+def random_plan(rng):
+    horizon = rng.randint(1, 48)
+    appliance_durations = [rng.randint(1, 3) for _ in range(rng.randint(0, 4))]
+    columns = []
+    for cycle_duration in appliance_durations:
+        column = []
+        while len(column) < horizon:
+            column += [rng.randint(0, 1)] * cycle_duration * rng.randint(1, 3)
+        column = column[:horizon - horizon % cycle_duration] + [0] * (horizon % cycle_duration)
+        columns.append(column)
+    battery = [rng.choice([-1, 0, 1]) for _ in range(horizon)]
+    plan = [{"appliances": [column[timestep] for column in columns], "battery": battery[timestep]} for timestep in range(horizon)]
+    return plan, [f"Appliance {index}" for index in range(len(appliance_durations))], appliance_durations
+
+
+def reference_tasks(plan, appliance_labels, appliance_durations):
+    tasks = []
+    if len(plan) == 0:
+        return tasks
+    battery_index = len(plan[0]["appliances"])
+    for device_index in range(battery_index + 1):
+        column = [action["battery"] if device_index == battery_index else action["appliances"][device_index] for action in plan]
+        timestep = 0
+        for action, group in groupby(column):
+            duration = len(list(group))
+            if action != 0:
+                if device_index == battery_index:
+                    tasks.append({"device": "Battery", "action": "Discharge" if action == -1 else "Charge", "start": timestep, "duration": duration})
+                else:
+                    cycle_duration = appliance_durations[device_index]
+                    for cycle_start in range(timestep, timestep + duration, cycle_duration):
+                        tasks.append({"device": appliance_labels[device_index], "action": "On", "start": cycle_start, "duration": cycle_duration})
+            timestep += duration
+    return tasks
+
+
+def test_find_runs_parity():
+    rng = random.Random(0)
+    for _ in range(500):
+        timesteps, columns = rng.randint(1, 48), rng.randint(1, 6)
+        actions = np.array([[rng.choice([-1, 0, 1]) for _ in range(columns)] for _ in range(timesteps)], dtype=np.int8)
+        expected = [runs.tolist() for runs in find_runs_numpy(actions)]
+        assert [runs.tolist() for runs in scan_runs(actions)] == expected
+        assert [runs.tolist() for runs in find_runs(actions)] == expected
+
+
+def test_build_tasks_parity():
+    rng = random.Random(0)
+    assert build_tasks([], [], []) == []
+    for _ in range(500):
+        plan, appliance_labels, appliance_durations = random_plan(rng)
+        assert build_tasks(plan, appliance_labels, appliance_durations) == reference_tasks(plan, appliance_labels, appliance_durations)